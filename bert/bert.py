@@ -5,24 +5,29 @@ import sys
 import math
 import random
 import datetime
-from functools import reduce
-from collections import deque
-from collections import defaultdict
-from itertools import chain
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import logging
 
 import popart
 import numpy as np
 from torch.utils.tensorboard import SummaryWriter
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from bert_model import Bert, BertConfig
 from bert_data import get_pretraining_dataset, get_squad_dataset
-from bert_tf_loader import load_initializers_from_tf
 from bert_optimizer import ScheduledOptimizerFactory
 import utils
 
 logger = logging.getLogger('BERT')
 
+# Anchor return types are copied into the DataFlow so a single instance can be shared by all outputs
+_ANCHOR_ALL = popart.AnchorReturnType("ALL")
+
 
 def set_library_seeds(seed):
     np.random.seed(seed)
@@ -119,7 +124,7 @@ def bert_loss_graph(model, probs, labels):
 def bert_add_infer_outputs(model, logits):
     outputs = {}
     for logit in logits:
-        outputs[logit] = popart.AnchorReturnType("ALL")
+        outputs[logit] = _ANCHOR_ALL
     for out in outputs.keys():
         model.builder.addOutputTensor(out)
     return outputs
@@ -128,9 +133,9 @@ def bert_add_infer_outputs(model, logits):
 def bert_add_validation_outputs(model, predictions, losses):
     outputs = {}
     for pred in predictions:
-        outputs[pred] = popart.AnchorReturnType("ALL")
+        outputs[pred] = _ANCHOR_ALL
     for loss in losses:
-        outputs[loss.output(0)] = popart.AnchorReturnType("ALL")
+        outputs[loss.output(0)] = _ANCHOR_ALL
     for out in outputs.keys():
         model.builder.addOutputTensor(out)
     return outputs
@@ -201,11 +206,18 @@ def bert_session_options(args, model):
 def calc_required_ipus(args, model):
     num_ipus = math.ceil(model.config.num_layers / model.config.layers_per_ipu) + model.layer_offset
     num_ipus *= args.replication_factor
-    request_ipus = pow(2, math.ceil(math.log2(num_ipus)))
+    # Round up to the next power of two with integer arithmetic (avoids float rounding in log2)
+    request_ipus = 1 << (num_ipus - 1).bit_length()
     logger.info(f"Need {num_ipus} IPUs. Requesting {request_ipus}")
     return request_ipus, num_ipus
 
 
+def save_gc_profile(session, **kwargs):
+    # gcprofile is only needed when profiling so it is imported on first use
+    import gcprofile
+    gcprofile.save_popart_report(session, **kwargs)
+
+
 def compile_graph_checked(args, session):
     try:
         start_time = time.time()
@@ -214,8 +226,7 @@ def compile_graph_checked(args, session):
         logger.info(f"Compiled. Duration {end_time - start_time} seconds")
     except popart.PrepareDeviceException as e:
         if args.gc_profile:
-            import gcprofile
-            gcprofile.save_popart_report(session, exception=e)
+            save_gc_profile(session, exception=e)
         raise e
 
 
@@ -284,7 +295,8 @@ def bert_writer(args):
                f"{datetime.datetime.now().isoformat()}"
     log_dir = os.path.join(
         args.log_dir, log_name)
-    writer = SummaryWriter(log_dir=log_dir)
+    # Queue events in memory and flush infrequently to keep file writes off the training loop
+    writer = SummaryWriter(log_dir=log_dir, max_queue=10000, flush_secs=120)
     return writer
 
 
@@ -292,7 +304,7 @@ def get_bert_dataset(model, args, inputs):
     config = model.config
     shapeOf = model.builder.getTensorShape
     # The inputs after the first three (ind, pos, seg) are always lists
-    inputs = reduce(chain, inputs[3:], inputs[:3])
+    inputs = list(inputs[:3]) + [tensorId for sub_inputs in inputs[3:] for tensorId in sub_inputs]
     tensor_shapes = [(tensorId, shapeOf(tensorId)) for tensorId in inputs]
     if config.task == "PRETRAINING":
         return get_pretraining_dataset(
@@ -332,42 +344,87 @@ def get_bert_dataset(model, args, inputs):
             max_pipeline_stage=model.total_pipeline_stages if args.execution_mode == "PIPELINE" else 1)
 
 
-def bert_output_stats(labels, anchors, losses, predictions, ignore_index=None):
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def _reduce_kernel(labels_stack, loss_stack, pred_stack, use_ignore_index, ignore_index):
+        # Fused equivalent of the NumPy path in bert_output_stats.
+        # All stacks are [num_outputs, num_tokens]. When use_ignore_index is False
+        # (SQuAD) every entry counts towards the loss and accuracy.
+        num_outputs, num_tokens = labels_stack.shape
+        total_loss = 0.0
+        active_tokens = 0
+        total_correct = 0
+        total_attempted = 0
+        for t in numba.prange(num_tokens):
+            token_loss = 0.0
+            token_attempted = 0
+            for i in range(num_outputs):
+                label = labels_stack[i, t]
+                if not use_ignore_index or label != ignore_index:
+                    token_loss += loss_stack[i, t]
+                    token_attempted += 1
+                    if pred_stack[i, t] == label:
+                        total_correct += 1
+            if token_attempted > 0:
+                total_loss += token_loss / token_attempted
+                active_tokens += 1
+                total_attempted += token_attempted
+        # Every label can be ignored (e.g. all MLM labels out of vocab). Match the NumPy path with nan
+        # rather than raising ZeroDivisionError.
+        if active_tokens == 0:
+            return np.nan, np.nan
+        return total_loss / active_tokens, total_correct / total_attempted
+else:
+    _reduce_kernel = None
+
+
+def bert_output_stats(labels, losses, predictions, ignore_index=None):
+    # `losses` and `predictions` are the anchor arrays themselves, looked up once before the training loop.
+    # Stack the per-output arrays so every reduction is a single pass over the data.
+    labels_arr = np.stack(labels)
+    if _reduce_kernel is not None:
+        num_outputs = len(labels)
+        # Numba has no float16 arithmetic on the CPU so the losses are reduced in float32.
+        return _reduce_kernel(labels_arr.reshape(num_outputs, -1),
+                              np.stack(losses).astype(np.float32, copy=False).reshape(num_outputs, -1),
+                              np.stack(predictions).reshape(num_outputs, -1),
+                              ignore_index is not None,
+                              0 if ignore_index is None else ignore_index)
+
     if ignore_index is not None:
-        padding_masks = [label != ignore_index for label in labels]
+        mask = labels_arr != ignore_index
     else:
-        padding_masks = [np.ones(label.shape, np.bool) for label in labels]
+        mask = np.ones(labels_arr.shape, np.bool)
+
+    # Stack the losses with padded entries zeroed in a single pass.
+    # This writes into a new buffer so the anchor arrays are left untouched.
+    # Padded entries are selected away rather than multiplied by 0, as they can hold inf or nan.
+    losses_arr = np.zeros((len(losses),) + losses[0].shape, dtype=losses[0].dtype)
+    for loss, loss_mask, masked_loss in zip(losses, mask, losses_arr):
+        np.copyto(masked_loss, loss, where=loss_mask)
 
     # TODO: Come up with a better name for num_losses
-    num_losses = np.sum(np.array(padding_masks, dtype=np.int8), axis=0)
-    master_mask = num_losses != 0
-    for loss, mask in zip(losses, padding_masks):
-        anchors[loss][np.logical_not(mask)] = 0
-    combined_loss = reduce(np.add, map(lambda loss: anchors[loss], losses))
-    # Mask both num_losses and combined_loss to remove entries where all labels are ignored
-    num_losses = num_losses[master_mask]
-    combined_loss = combined_loss[master_mask]
-    # Calculate mean loss for each token
-    combined_loss /= num_losses
-    # Calculate mean loss for step
-    step_loss = np.mean(combined_loss)
-
-    total_correct = 0
-    for pred, label, mask in zip(map(lambda p: anchors[p], predictions),
-                                 labels,
-                                 padding_masks):
-        equal = pred == label
-        total_correct += np.sum(equal[mask])
+    # There are only ever a couple of outputs so the count fits in a uint8
+    num_losses = mask.sum(axis=0, dtype=np.uint8)
+    combined_loss = losses_arr.sum(axis=0)
+    # Calculate mean loss for each token. Entries where all labels are ignored
+    # have a combined_loss of 0 so dividing them by 1 leaves them at 0.
+    combined_loss /= np.maximum(num_losses, 1)
+    # Calculate mean loss for step, excluding entries where all labels are ignored
+    step_loss = combined_loss.sum(dtype=np.float32) / np.count_nonzero(num_losses)
+
+    preds_arr = np.stack(predictions)
+    total_correct = np.sum((preds_arr == labels_arr) & mask)
     total_attempted = np.sum(num_losses)
     step_accuracy = total_correct / total_attempted
     return step_loss, step_accuracy
 
 
-def bert_pretraining_stats(labels, anchors, losses, predictions):
+def bert_pretraining_stats(labels, losses, predictions):
     mlm_loss, mlm_acc = bert_output_stats(
-        [labels[0]], anchors, [losses[0]], [predictions[0]], 0)
+        [labels[0]], [losses[0]], [predictions[0]], 0)
     nsp_loss, nsp_acc = bert_output_stats(
-        [labels[1]], anchors, [losses[1]], [predictions[1]], 2)
+        [labels[1]], [losses[1]], [predictions[1]], 2)
     return [mlm_loss, nsp_loss], [mlm_acc, nsp_acc]
 
 
@@ -385,6 +442,51 @@ def save_model_and_stats(args, session, writer, step, epoch=None, step_in_filena
         utils.save_model_statistics(save_path, writer, step)
 
 
+class RollingAverage:
+    """
+    Mean of the last `length` values appended. Values are kept in a ring buffer
+    alongside a running total so both `append` and `mean` are O(1).
+    """
+    def __init__(self, length):
+        self.values = np.zeros(length, dtype=np.float64)
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+        # nan and inf are kept out of the running total, which could never recover from them,
+        # and counted instead so the mean only reflects them while they are in the window.
+        self.non_finite = 0
+
+    def append(self, value):
+        old = self.values[self.index]
+        if math.isfinite(old):
+            self.total -= old
+        else:
+            self.non_finite -= 1
+        if math.isfinite(value):
+            self.total += value
+        else:
+            self.non_finite += 1
+        self.values[self.index] = value
+        self.index = (self.index + 1) % len(self.values)
+        self.count = min(self.count + 1, len(self.values))
+
+    def mean(self):
+        if self.non_finite:
+            return np.mean(self.values[:self.count])
+        return self.total / self.count
+
+    def __len__(self):
+        return self.count
+
+    def __array__(self, dtype=None):
+        # The recorded values, oldest first
+        values = np.roll(self.values, -self.index)[len(self.values) - self.count:]
+        return values if dtype is None else values.astype(dtype)
+
+    def __getitem__(self, index):
+        return np.asarray(self)[index]
+
+
 class Iteration:
     def __init__(self, args, batches_per_step, steps_per_epoch, writer, recording_steps=None):
         self.start_epoch = args.continue_training_from_epoch
@@ -402,86 +504,97 @@ class Iteration:
         self.learning_rate = 0
         if recording_steps is None:
             recording_steps = self.steps_per_epoch
-        self.durations = deque(maxlen=recording_steps)
-        self.cycles = deque(maxlen=recording_steps)
+        self.durations = RollingAverage(recording_steps)
+        self.throughputs = RollingAverage(recording_steps)
+        self.cycles = RollingAverage(recording_steps)
         if self.task == "PRETRAINING":
-            self.mlm_losses = deque(maxlen=recording_steps)
-            self.nsp_losses = deque(maxlen=recording_steps)
-            self.mlm_accuracies = deque(maxlen=recording_steps)
-            self.nsp_accuracies = deque(maxlen=recording_steps)
+            self.mlm_losses = RollingAverage(recording_steps)
+            self.nsp_losses = RollingAverage(recording_steps)
+            self.mlm_accuracies = RollingAverage(recording_steps)
+            self.nsp_accuracies = RollingAverage(recording_steps)
             self.stats_fn = bert_pretraining_stats
         else:
-            self.losses = deque(maxlen=recording_steps)
-            self.accuracies = deque(maxlen=recording_steps)
+            self.losses = RollingAverage(recording_steps)
+            self.accuracies = RollingAverage(recording_steps)
             self.stats_fn = bert_output_stats
 
-    def add_stats(self, duration, hw_cycles, *args):
+    def add_duration(self, duration):
         self.durations.append(duration)
-        if hw_cycles:
+        self.throughputs.append(self.samples_per_step / duration)
+
+    def add_stats(self, duration, hw_cycles, *args):
+        self.add_duration(duration)
+        if hw_cycles is not None:
             self.cycles.append(hw_cycles)
         loss, accuracy = self.stats_fn(*args)
-        self.writer.add_scalar("defaultLearningRate",
-                               self.learning_rate,
-                               self.count)
         if self.task == "PRETRAINING":
             self.mlm_losses.append(loss[0])
             self.nsp_losses.append(loss[1])
             self.mlm_accuracies.append(accuracy[0])
             self.nsp_accuracies.append(accuracy[1])
+        else:
+            self.losses.append(loss)
+            self.accuracies.append(accuracy)
+        # The rolling averages smooth over the steps in between so only write them out when logging.
+        if (self.count % self.steps_per_log) == 0:
+            self.write_stats()
+
+    def write_stats(self):
+        self.writer.add_scalar("defaultLearningRate",
+                               self.learning_rate,
+                               self.count)
+        if self.task == "PRETRAINING":
             self.writer.add_scalar("loss/MLM",
-                                   np.average(self.mlm_losses),
+                                   self.mlm_losses.mean(),
                                    self.count)
             self.writer.add_scalar("loss/NSP",
-                                   np.average(self.nsp_losses),
+                                   self.nsp_losses.mean(),
                                    self.count)
             self.writer.add_scalar("accuracy/MLM",
-                                   np.average(self.mlm_accuracies),
+                                   self.mlm_accuracies.mean(),
                                    self.count)
             self.writer.add_scalar("accuracy/NSP",
-                                   np.average(self.nsp_accuracies),
+                                   self.nsp_accuracies.mean(),
                                    self.count)
         else:
-            self.losses.append(loss)
-            self.accuracies.append(accuracy)
             self.writer.add_scalar("loss",
-                                   np.average(self.losses),
+                                   self.losses.mean(),
                                    self.count)
             self.writer.add_scalar("accuracy",
-                                   np.average(self.accuracies),
+                                   self.accuracies.mean(),
                                    self.count)
 
     @property
     def throughput(self):
-        return np.divide(self.samples_per_step, self.durations)
+        return self.throughputs.mean()
 
     def report_stats(self):
-        avg = np.average
         status_string = \
             f"Iteration: {self.count:6} " \
             f"Epoch: {self.count/self.steps_per_epoch:6.2f}/{self.epochs} "
         if self.task == "PRETRAINING":
             status_string += \
-                f"Loss (MLM NSP): {avg(self.mlm_losses):5.3f} {avg(self.nsp_losses):5.3f} " \
-                f"Accuracy (MLM NSP): {avg(self.mlm_accuracies):5.3f} {avg(self.nsp_accuracies):5.3f} "
+                f"Loss (MLM NSP): {self.mlm_losses.mean():5.3f} {self.nsp_losses.mean():5.3f} " \
+                f"Accuracy (MLM NSP): {self.mlm_accuracies.mean():5.3f} {self.nsp_accuracies.mean():5.3f} "
         else:
             status_string += \
-                f"Loss: {avg(self.losses):5.3f} " \
-                f"Accuracy: {avg(self.accuracies):5.3f} "
+                f"Loss: {self.losses.mean():5.3f} " \
+                f"Accuracy: {self.accuracies.mean():5.3f} "
         status_string += \
             f"Learning Rate: {self.learning_rate:.5f} "
         status_string += \
-            f"Duration: {avg(self.durations):6.4f} s " \
-            f"Throughput: {avg(self.throughput):6.1f} samples/s"
+            f"Duration: {self.durations.mean():6.4f} s " \
+            f"Throughput: {self.throughput:6.1f} samples/s"
         if self.cycles:
-            status_string += f" Cycles: {avg(self.cycles)}"
+            status_string += f" Cycles: {self.cycles.mean()}"
         logger.info(status_string)
 
 
 def bert_process_data(args, session, labels, data, anchors,
-                      losses, predictions, iteration: Iteration,
+                      loss_views, pred_views, iteration: Iteration,
                       optimizer_factory: ScheduledOptimizerFactory):
     labels_data = [data[label] for label in labels]
-    if not np.any([np.any(label) for label in labels_data]):
+    if not any(label.any() for label in labels_data):
         # Label may be all padding due to args.vocab_length being smaller than when the data was generated
         return
 
@@ -490,16 +603,17 @@ def bert_process_data(args, session, labels, data, anchors,
     start = time.time()
     session.run(stepio)
     duration = time.time() - start
-    hw_cycles = session.getCycleCount() if args.report_hw_cycle_count else None
+    # Reading the cycle count requires a device round-trip so only do it when the value will be logged
+    is_log_step = (iteration.count % iteration.steps_per_log) == 0
+    hw_cycles = session.getCycleCount() if args.report_hw_cycle_count and is_log_step else None
 
     if args.gc_profile:
-        import gcprofile
-        gcprofile.save_popart_report(session)
+        save_gc_profile(session)
         sys.exit(0)
 
-    iteration.add_stats(duration, hw_cycles, labels_data, anchors, losses, predictions)
+    iteration.add_stats(duration, hw_cycles, labels_data, loss_views, pred_views)
 
-    if (iteration.count % iteration.steps_per_log) == 0:
+    if is_log_step:
         iteration.report_stats()
 
     # The following will only be true if:
@@ -513,16 +627,55 @@ def bert_process_data(args, session, labels, data, anchors,
     iteration.count += 1
 
 
+class CallbackTimes:
+    """
+    Timestamps recorded by the stepio callbacks for each tensor ID during one step.
+    Each ID gets a preallocated array with one entry per batch in the step.
+    """
+    def __init__(self, batches_per_step):
+        self.batches_per_step = batches_per_step
+        self.times = {}
+        self.counts = {}
+        # The ID used for timing, found on the first step by get_timing_start_anchor/get_timing_end_anchor
+        self.timing_anchor = None
+
+    def record(self, id):
+        timestamp = time.perf_counter()
+        if id not in self.times:
+            self.times[id] = np.empty(self.batches_per_step, dtype=np.float64)
+            self.counts[id] = 0
+        count = self.counts[id]
+        if count < self.batches_per_step:
+            self.times[id][count] = timestamp
+        self.counts[id] = count + 1
+
+    def last(self, id):
+        return self.times[id][min(self.counts[id], self.batches_per_step) - 1]
+
+    def clear(self):
+        for id in self.counts:
+            self.counts[id] = 0
+
+    def __iter__(self):
+        return iter(self.times)
+
+
 def get_timing_start_anchor(start_times):
     # Return the ID of the first input that is sent from the host.
-    # Order is repeateable so we can just check the time for one entry:
-    return min(start_times, key=lambda k: start_times[k][-1])
+    # Order is repeateable so we can just check the time for one entry
+    # and only need to search on the first step:
+    if start_times.timing_anchor is None:
+        start_times.timing_anchor = min(start_times, key=start_times.last)
+    return start_times.timing_anchor
 
 
 def get_timing_end_anchor(end_times):
     # Return the ID of the last anchor that is returned to the host.
-    # Order is repeateable so we can just check the time for one entry:
-    return max(end_times, key=lambda k: end_times[k][-1])
+    # Order is repeateable so we can just check the time for one entry
+    # and only need to search on the first step:
+    if end_times.timing_anchor is None:
+        end_times.timing_anchor = max(end_times, key=end_times.last)
+    return end_times.timing_anchor
 
 
 def create_callback_stepio(data, anchors, start_times, end_times):
@@ -530,8 +683,7 @@ def create_callback_stepio(data, anchors, start_times, end_times):
     # Input callback is called when the data is needed:
     def input_callback(id, is_prefetch: bool):
         if is_prefetch:
-            input_time = time.perf_counter()
-            start_times[id].append(input_time)
+            start_times.record(id)
         return data[id]
 
     # Called after the input buffer has been consumed by the device:
@@ -545,8 +697,7 @@ def create_callback_stepio(data, anchors, start_times, end_times):
     # Complete callback is called when the output buffer has
     # been filled (result is ready to be consumed by the host):
     def output_complete_callback(id):
-        output_time = time.perf_counter()
-        end_times[id].append(output_time)
+        end_times.record(id)
 
     stepio = popart.PyStepIOCallback(input_callback,
                                      input_complete_callback,
@@ -564,12 +715,13 @@ def compute_latency(args, start_times, end_times):
         # two anchors most separated in time:
         start_id = get_timing_start_anchor(start_times)
         end_id = get_timing_end_anchor(end_times)
-        rtts = list(map(lambda v: v[1]-v[0], zip(start_times[start_id], end_times[end_id])))
-        if len(rtts) != args.batches_per_step:
+        if (start_times.counts[start_id] != args.batches_per_step or
+                end_times.counts[end_id] != args.batches_per_step):
             raise RuntimeError("Number of timings doesn't match items in the batch. Something is wrong.")
-        mean_latency = (sum(rtts))/args.batches_per_step
-        min_latency = min(rtts)
-        max_latency = max(rtts)
+        rtts = end_times.times[end_id] - start_times.times[start_id]
+        mean_latency = rtts.mean()
+        min_latency = rtts.min()
+        max_latency = rtts.max()
         if (logging.getLogger().isEnabledFor(logging.DEBUG)):
             for i, v in enumerate(rtts):
                 logging.debug(f"LATENCY: {i} {v}")
@@ -585,22 +737,23 @@ def bert_process_infer_data(args, session, data, anchors,
     start = time.perf_counter()
     session.run(stepio)
     duration = time.perf_counter() - start
-    hw_cycles = session.getCycleCount() if args.report_hw_cycle_count else None
+    # Reading the cycle count requires a device round-trip so only do it when the value will be logged
+    is_log_step = (iteration.count % iteration.steps_per_log) == 0
+    hw_cycles = session.getCycleCount() if args.report_hw_cycle_count and is_log_step else None
 
     if args.gc_profile:
-        import gcprofile
-        gcprofile.save_popart_report(session)
+        save_gc_profile(session)
         sys.exit(0)
 
-    iteration.durations.append(duration)
+    iteration.add_duration(duration)
 
     mean_latency, min_latency, max_latency = compute_latency(args, start_times, end_times)
 
-    if (iteration.count % iteration.steps_per_log) == 0:
+    if is_log_step:
         status_string = \
             f"Iteration: {iteration.count:6} " \
-            f"Duration: {np.average(iteration.durations):6.4f} s " \
-            f"Throughput: {np.average(iteration.throughput):6.1f} samples/s"
+            f"Duration: {iteration.durations.mean():6.4f} s " \
+            f"Throughput: {iteration.throughput:6.1f} samples/s"
         if mean_latency is not None:
             status_string += f" Per-sample Latency: {mean_latency} {min_latency} {max_latency} seconds (mean min max)"
         if hw_cycles is not None:
@@ -612,17 +765,80 @@ def bert_process_infer_data(args, session, data, anchors,
     return [anchors[logit] for logit in logits]
 
 
+_END_OF_DATA = object()
+
+
+class PrefetchIterator:
+    """
+    Iterates over a dataset on a background thread, fetching up to `depth` batches
+    ahead so host-side data preparation overlaps with session.run.
+    Each call to `iter` starts a new pass over the dataset. A depth of 0 disables prefetching.
+    """
+    def __init__(self, dataset, depth=2):
+        self.dataset = dataset
+        self.depth = depth
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __iter__(self):
+        if self.depth < 1:
+            return iter(self.dataset)
+        return self._prefetch()
+
+    def _prefetch(self):
+        items = queue.Queue(maxsize=self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            # Stop waiting for space if the consumer has gone away so the thread can't block forever.
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def produce():
+            try:
+                for item in self.dataset:
+                    put(item)
+                    if stop.is_set():
+                        return
+            finally:
+                put(_END_OF_DATA)
+
+        executor = ThreadPoolExecutor(max_workers=1)
+        future = executor.submit(produce)
+        try:
+            while True:
+                item = items.get()
+                if item is _END_OF_DATA:
+                    break
+                yield item
+            # Re-raise any exception from the dataset
+            future.result()
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+
 def bert_train_loop(args, session, writer,
                     dataset, labels, predictions, losses, anchors,
                     iteration, optimizer_factory):
     losses = [loss.output(0) for loss in losses]
+    # The anchor arrays are filled in-place by every session.run so they only need to be looked up once:
+    loss_views = [anchors[loss] for loss in losses]
+    pred_views = [anchors[pred] for pred in predictions]
 
     save_model_and_stats(args, session, writer, iteration.count, iteration.epoch)
 
+    batches = PrefetchIterator(dataset, args.prefetch_depth)
+
     for iteration.epoch in range(iteration.start_epoch, args.epochs):
-        for data in dataset:
+        for data in batches:
             bert_process_data(args, session, labels, data, anchors,
-                              losses, predictions, iteration, optimizer_factory)
+                              loss_views, pred_views, iteration, optimizer_factory)
 
             if args.steps_per_save > 0 and (iteration.count % args.steps_per_save) == 0:
                 save_model_and_stats(args, session, writer, iteration.count, iteration.epoch, True)
@@ -633,22 +849,27 @@ def bert_train_loop(args, session, writer,
     save_model_and_stats(args, session, writer, iteration.count)
 
 
+def set_scheduler(policy, priority, chrt_args):
+    pid = os.getpid()
+    try:
+        os.sched_setscheduler(0, policy, os.sched_param(priority))
+    except PermissionError:
+        # Without CAP_SYS_NICE fall back to setting it via sudo
+        os.system(f"sudo -n chrt {chrt_args} -p {priority} {pid}")
+
+
 def enable_realtime_scheduling(args):
     if args.realtime_scheduler:
-        # Use a system call to enable real-time scheduling
-        # for the whole process:
-        pid = os.getpid()
-        logger.info(f"Enabling real-time scheduler for process: PID {pid}")
-        os.system(f"sudo -n chrt --rr -p 99 {pid}")
+        # Enable real-time scheduling for the whole process:
+        logger.info(f"Enabling real-time scheduler for process: PID {os.getpid()}")
+        set_scheduler(os.SCHED_RR, 99, "--rr")
 
 
 def disable_realtime_scheduling(args):
     if args.realtime_scheduler:
-        # Use a system call to reset to default scheduling
-        # for the whole process:
-        pid = os.getpid()
-        logger.info(f"Disabling real-time scheduler for process: PID {pid}")
-        os.system(f"sudo -n chrt --other -p 0 {pid}")
+        # Reset to default scheduling for the whole process:
+        logger.info(f"Disabling real-time scheduler for process: PID {os.getpid()}")
+        set_scheduler(os.SCHED_OTHER, 0, "--other")
 
 
 def bert_infer_loop(args, session,
@@ -662,25 +883,45 @@ def bert_infer_loop(args, session,
 
     # Create the stepio once outside of the inference loop:
     static_data = {}
-    start_times = defaultdict(list)
-    end_times = defaultdict(list)
+    start_times = CallbackTimes(args.batches_per_step)
+    end_times = CallbackTimes(args.batches_per_step)
+    anchor_sets = [anchors]
+    stepio = None
     if args.low_latency_inference and args.task == "SQUAD":
         stepio = create_callback_stepio(static_data, anchors, start_times, end_times)
-    else:
-        stepio = None
+    elif save_results:
+        # Double-buffer the anchors so the results of one step can be processed
+        # on a background thread while the next step writes to the other set.
+        anchor_sets.append({id: np.empty_like(anchor) for id, anchor in anchors.items()})
+    # The results still being processed from each anchor set
+    pending = [None] * len(anchor_sets)
+    buffer = 0
+
+    batches = PrefetchIterator(dataset, args.prefetch_depth)
 
     enable_realtime_scheduling(args)
 
-    for iteration.epoch in range(repeat_count):
-        for data in dataset:
-            static_data.update(data)
-            result = bert_process_infer_data(args, session, static_data, anchors,
-                                             logits, iteration,
-                                             start_times, end_times, stepio)
-            if save_results:
-                dataset.add_results(data, result)
-            start_times.clear()
-            end_times.clear()
+    # A single worker keeps the results in the same order as the data.
+    with ThreadPoolExecutor(max_workers=1) as results_executor:
+        for iteration.epoch in range(repeat_count):
+            for data in batches:
+                static_data.update(data)
+                # Only wait if the results from the last use of this anchor set haven't been processed yet
+                if pending[buffer] is not None:
+                    pending[buffer].result()
+                result = bert_process_infer_data(args, session, static_data, anchor_sets[buffer],
+                                                 logits, iteration,
+                                                 start_times, end_times, stepio)
+                if save_results:
+                    pending[buffer] = results_executor.submit(dataset.add_results, data, result)
+                start_times.clear()
+                end_times.clear()
+                buffer = (buffer + 1) % len(anchor_sets)
+
+        # Re-raise any exception from processing the results
+        for future in pending:
+            if future is not None:
+                future.result()
 
     disable_realtime_scheduling(args)
 
@@ -711,8 +952,12 @@ def bert_pretrained_initialisers(config, args):
         logger.info(f"Initialising from ONNX checkpoint: {args.onnx_checkpoint}")
         return utils.load_initializers_from_onnx(args.onnx_checkpoint)
     if args.tf_checkpoint:
+        # Only pull in the TF loader (and TensorFlow) when a TF checkpoint is actually used
+        from bert_tf_loader import load_initializers_from_tf
         logger.info(f"Initialising from TF checkpoint: {args.tf_checkpoint}")
-        return load_initializers_from_tf(args.tf_checkpoint, True, config)
+        return load_initializers_from_tf(args.tf_checkpoint, True, config,
+                                         use_cache=args.cache_loaded_weights,
+                                         npz_cache=args.tf_checkpoint_npz_cache)
     return None
 
 
@@ -1,5 +1,7 @@
 # Copyright 2019 Graphcore Ltd.
 import argparse
+import functools
+import hashlib
 import os
 import logging
 import numpy as np
@@ -7,44 +9,64 @@ import popart
 import onnx
 import re
 import json
+from collections import defaultdict
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict
 from onnx import numpy_helper
 from logging import getLogger
 
 from bert_model import BertConfig, Bert
+from utils import save_model_with_external_data
 
 logger = getLogger(__name__)
 
+# Initializers already loaded in this process, see `load_initializers_from_tf`
+_INIT_CACHE: Dict[tuple, dict] = {}
+
+
+_STATIC_TF_MAPPING = {
+    "bert/embeddings/word_embeddings": "Embedding/Embedding_Dict",
+    "bert/embeddings/position_embeddings": "Embedding/Positional_Dict",
+    "bert/embeddings/token_type_embeddings": "Embedding/Segment_Dict",
+    "bert/embeddings/LayerNorm/gamma": "Embedding/Gamma",
+    "bert/embeddings/LayerNorm/beta": "Embedding/Beta",
+    "cls/predictions/transform/dense/kernel": "CLS/LMPredictionW",
+    "cls/predictions/transform/dense/bias": "CLS/LMPredictionB",
+    "cls/predictions/transform/LayerNorm/gamma": "CLS/Gamma",
+    "cls/predictions/transform/LayerNorm/beta": "CLS/Beta"
+}
+
+_LAYER_TF_MAPPING_TEMPLATES = (
+    ("bert/encoder/layer_{i}/attention/self/query/kernel", "Layer{i}/Attention/QKV"),
+    ("bert/encoder/layer_{i}/attention/self/key/kernel", "Layer{i}/Attention/QKV"),
+    ("bert/encoder/layer_{i}/attention/self/value/kernel", "Layer{i}/Attention/QKV"),
+    ("bert/encoder/layer_{i}/attention/output/dense/kernel", "Layer{i}/Attention/Out"),
+    ("bert/encoder/layer_{i}/attention/output/LayerNorm/gamma", "Layer{i}/Attention/Gamma"),
+    ("bert/encoder/layer_{i}/attention/output/LayerNorm/beta", "Layer{i}/Attention/Beta"),
+    ("bert/encoder/layer_{i}/intermediate/dense/kernel", "Layer{i}/FF/1/W"),
+    ("bert/encoder/layer_{i}/intermediate/dense/bias", "Layer{i}/FF/1/B"),
+    ("bert/encoder/layer_{i}/output/dense/kernel", "Layer{i}/FF/2/W"),
+    ("bert/encoder/layer_{i}/output/dense/bias", "Layer{i}/FF/2/B"),
+    ("bert/encoder/layer_{i}/output/LayerNorm/gamma", "Layer{i}/FF/Gamma"),
+    ("bert/encoder/layer_{i}/output/LayerNorm/beta", "Layer{i}/FF/Beta"),
+)
+
+
+@functools.lru_cache(maxsize=4)
+def _tf_mapping_for_layers(num_layers):
+    return {
+        **_STATIC_TF_MAPPING,
+        **{tf_name.format(i=i): onnx_name.format(i=i)
+           for i in range(num_layers)
+           for tf_name, onnx_name in _LAYER_TF_MAPPING_TEMPLATES}
+    }
+
 
 def get_tf_mapping(config):
-    tf_to_onnx = {
-        "bert/embeddings/word_embeddings": "Embedding/Embedding_Dict",
-        "bert/embeddings/position_embeddings": "Embedding/Positional_Dict",
-        "bert/embeddings/token_type_embeddings": "Embedding/Segment_Dict",
-        "bert/embeddings/LayerNorm/gamma": "Embedding/Gamma",
-        "bert/embeddings/LayerNorm/beta": "Embedding/Beta",
-        "cls/predictions/transform/dense/kernel": "CLS/LMPredictionW",
-        "cls/predictions/transform/dense/bias": "CLS/LMPredictionB",
-        "cls/predictions/transform/LayerNorm/gamma": "CLS/Gamma",
-        "cls/predictions/transform/LayerNorm/beta": "CLS/Beta"
-    }
-    for i in range(config.num_layers):
-        layer = {
-            f"bert/encoder/layer_{i}/attention/self/query/kernel": f"Layer{i}/Attention/QKV",
-            f"bert/encoder/layer_{i}/attention/self/key/kernel": f"Layer{i}/Attention/QKV",
-            f"bert/encoder/layer_{i}/attention/self/value/kernel": f"Layer{i}/Attention/QKV",
-            f"bert/encoder/layer_{i}/attention/output/dense/kernel": f"Layer{i}/Attention/Out",
-            f"bert/encoder/layer_{i}/attention/output/LayerNorm/gamma": f"Layer{i}/Attention/Gamma",
-            f"bert/encoder/layer_{i}/attention/output/LayerNorm/beta": f"Layer{i}/Attention/Beta",
-            f"bert/encoder/layer_{i}/intermediate/dense/kernel": f"Layer{i}/FF/1/W",
-            f"bert/encoder/layer_{i}/intermediate/dense/bias": f"Layer{i}/FF/1/B",
-            f"bert/encoder/layer_{i}/output/dense/kernel": f"Layer{i}/FF/2/W",
-            f"bert/encoder/layer_{i}/output/dense/bias": f"Layer{i}/FF/2/B",
-            f"bert/encoder/layer_{i}/output/LayerNorm/gamma": f"Layer{i}/FF/Gamma",
-            f"bert/encoder/layer_{i}/output/LayerNorm/beta": f"Layer{i}/FF/Beta",
-        }
-        tf_to_onnx.update(**layer)
-    return tf_to_onnx
+    # The mapping only depends on the number of layers so it is cached.
+    # Callers share the cached dict so they are given a read-only view of it.
+    return MappingProxyType(_tf_mapping_for_layers(config.num_layers))
 
 
 def load_bert_config_tf(config_path):
@@ -87,63 +109,78 @@ def generate_initializers(mapping, config, map_names, load_data):
     concatenating the weight tensors Q, K and V.
     """
     initializers = {}
-    qkv_tensor_range = {
-        "query": (0, config.hidden_size),
-        "key": (config.hidden_size, config.hidden_size * 2),
-        "value": (config.hidden_size * 2, config.hidden_size * 3),
-    }
+    # Q, K and V components of each QKV tensor, grouped by the target tensor name
+    qkv_parts = defaultdict(dict)
+    # The config is fixed for the whole load, so decide up front which targets need special handling
+    qkv_targets = frozenset(target for target in mapping.values() if target.endswith("QKV"))
+    if "gather" in config.custom_ops:
+        transposed_targets = frozenset(("Embedding/Embedding_Dict", "Embedding/Positional_Dict"))
+    else:
+        transposed_targets = frozenset()
 
     for name, array in zip(map_names, load_data):
-        logger.debug(f"Initialising tensor from checkpoint {name} -> {mapping[name]}")
-
-        if array.dtype == np.float32 and config.dtype == np.float16:
-            array = array.astype(config.dtype)
+        target = mapping[name]
+        logger.debug(f"Initialising tensor from checkpoint {name} -> {target}")
 
         # If it's part of QKV, we need to handle separately as those 3
         # tensors need concatenating into one
-        if mapping[name][-3:] == "QKV":
+        if target in qkv_targets:
             qkv_part = name.split("/")[-2]
-
-            if mapping[name] not in initializers.keys():
-                qkv_shape = (array.shape[0], array.shape[1] * 3)
-                initializers[mapping[name]] = np.empty(
-                    qkv_shape, dtype=array.dtype
-                )
-
-            start_idx = qkv_tensor_range[qkv_part][0]
-            end_idx = qkv_tensor_range[qkv_part][1]
-            initializers[mapping[name]][:, start_idx:end_idx] = array
-            logger.debug(f"Initialising QKV component {name}[{start_idx}:{end_idx}] from checkpoint")
+            qkv_parts[target][qkv_part] = array
             continue
 
-        if mapping[name] == "Embedding/Embedding_Dict":
+        if target == "Embedding/Embedding_Dict":
             tf_vocab_length = array.shape[0]
             diff = config.vocab_length - tf_vocab_length
-            # Pad or Crop the vocab.
+            # Pad or Crop the vocab. A matching vocab is used as is.
             if diff > 0:
                 logger.debug(f"Padding the vocabulary. From {tf_vocab_length} to {config.vocab_length}")
-                pad = np.zeros((diff, config.hidden_size)).astype(array.dtype)
-                array = np.concatenate((array, pad), axis=0)
-            else:
+                array = np.pad(array, ((0, diff), (0, 0)), mode="constant")
+            elif diff < 0:
                 logger.warn(f"Cropping the vocabulary may negatively effect performance. From {tf_vocab_length} to {config.vocab_length}")
-                array = np.array(array[:config.vocab_length, :])
-        if "gather" in config.custom_ops and mapping[name] in ["Embedding/Embedding_Dict", "Embedding/Positional_Dict"]:
-            array = np.transpose(array)
+                array = array[:config.vocab_length].copy()
+        if target in transposed_targets:
+            array = array.T
 
-        # FIXME: This copy is currently required to prevent popart misinterpreting the memory layout after the transpose.
+        # FIXME: A C-contiguous array is currently required to prevent popart misinterpreting the memory layout
+        # after the transpose. This only copies when the layout actually needs normalising.
         # Remove once T13187 is resolved.
-        initializers[mapping[name]] = array.copy()
+        initializers[target] = np.ascontiguousarray(array)
+
+    # Form each QKV tensor with a single contiguous copy of its components.
+    # Bert.attention projects with one matmul against this [hidden, 3*hidden] tensor and
+    # splits the result into sequential Q, K and V blocks, so the blocks must not be interleaved.
+    for qkv_name, parts in qkv_parts.items():
+        missing = {"query", "key", "value"} - parts.keys()
+        if missing:
+            raise ValueError(f"Cannot form {qkv_name}: missing the {', '.join(sorted(missing))} weights")
+        logger.debug(f"Initialising {qkv_name} from its query, key and value components")
+        initializers[qkv_name] = np.concatenate(
+            (parts["query"], parts["key"], parts["value"]), axis=1)
     return initializers
 
 
-def load_tf_frozen_data(tf_frozen_path, mapping):
+def cast_loaded_array(array, target_dtype=None):
+    """
+    Casts a float32 tensor read from TensorFlow to the float16 model dtype.
+    Other tensors are returned unchanged.
+    """
+    if target_dtype == np.float16 and array.dtype == np.float32:
+        return array.astype(target_dtype, copy=False)
+    return array
+
+
+def load_tf_frozen_data(tf_frozen_path, name_filter: frozenset, target_dtype=None):
     """
     Parses a frozen-graph and outputs a tensors (lists of names and data) found
-    in both the mapping and the checkpoint, ready for importing into the Bert
-    model.
+    in both `name_filter` (the TF names in the mapping) and the graph, ready
+    for importing into the Bert model.
+
+    If `target_dtype` is float16, float32 tensors are cast as they are decoded.
     """
     try:
         import tensorflow as tf
+        from tensorflow.core.framework import types_pb2
         from tensorflow.python.framework import tensor_util
     except ImportError:
         logger.error(
@@ -161,21 +198,42 @@ def load_tf_frozen_data(tf_frozen_path, mapping):
         graph_def.ParseFromString(f.read())
 
     # We'll search the graphdef for the nodes containing data we need to import
-    map_names = [n.name for n in graph_def.node if n.name in mapping.keys()]
-    load_data = [
-        tensor_util.MakeNdarray(n.attr["value"].tensor)
-        for n in graph_def.node
-        if n.name in mapping.keys()
-    ]
+    nodes = [n for n in graph_def.node if n.name in name_filter]
+    map_names = [n.name for n in nodes]
+    tensor_protos = [n.attr["value"].tensor for n in nodes]
+    tf_to_np = {
+        types_pb2.DT_FLOAT: np.float32,
+        types_pb2.DT_HALF: np.float16,
+        types_pb2.DT_DOUBLE: np.float64,
+        types_pb2.DT_INT32: np.int32,
+        types_pb2.DT_INT64: np.int64,
+    }
+
+    def decode(tensor_proto):
+        np_dtype = tf_to_np.get(tensor_proto.dtype)
+        if np_dtype is not None and tensor_proto.tensor_content:
+            # Packed tensors can be viewed directly without going through TF's per-dtype helpers
+            shape = [d.size for d in tensor_proto.tensor_shape.dim]
+            array = np.frombuffer(tensor_proto.tensor_content, dtype=np_dtype).reshape(shape)
+        else:
+            array = tensor_util.MakeNdarray(tensor_proto)
+        return cast_loaded_array(array, target_dtype)
+
+    # Decoding releases the GIL so the tensors can be converted in parallel.
+    # map preserves the order so load_data stays aligned with map_names.
+    with ThreadPoolExecutor(max_workers=min(32, len(tensor_protos)) or 1) as executor:
+        load_data = list(executor.map(decode, tensor_protos))
 
     return map_names, load_data
 
 
-def load_tf_ckpt_data(tf_checkpoint_path, mapping):
+def load_tf_ckpt_data(tf_checkpoint_path, name_filter: frozenset, target_dtype=None):
     """
     Parses a checkpoint file and outputs a tensors (lists of names and data)
-    found in both the mapping and the checkpoint, ready for importing into the
-    Bert model.
+    found in both `name_filter` (the TF names in the mapping) and the
+    checkpoint, ready for importing into the Bert model.
+
+    If `target_dtype` is float16, float32 tensors are cast as they are loaded.
     """
     try:
         import tensorflow as tf
@@ -192,31 +250,114 @@ def load_tf_ckpt_data(tf_checkpoint_path, mapping):
     # Load weights from TF model
     init_vars = tf.train.list_variables(tf_path)
 
-    map_names = [name for name, shape in init_vars if name in mapping.keys()]
-    load_data = [tf.train.load_variable(tf_path, name) for name in map_names]
+    map_names = [name for name, shape in init_vars if name in name_filter]
+
+    def load(name):
+        return cast_loaded_array(tf.train.load_variable(tf_path, name), target_dtype)
+
+    # Reading a variable releases the GIL during file I/O so they can be loaded in parallel.
+    # map preserves the order so load_data stays aligned with map_names.
+    with ThreadPoolExecutor(max_workers=min(32, len(map_names)) or 1) as executor:
+        load_data = list(executor.map(load, map_names))
 
     return map_names, load_data
 
 
+def clear_initializer_cache():
+    _INIT_CACHE.clear()
+
+
+def _tf_file_mtime(file_path):
+    # A checkpoint path is a prefix rather than a file, so fall back to its index file.
+    for path in (file_path, file_path + ".index"):
+        if os.path.exists(path):
+            return os.path.getmtime(path)
+    return None
+
+
+def _npz_cache_path(file_path, mapping, config):
+    # Everything that changes the output of generate_initializers goes into the hash.
+    description = repr((sorted(mapping.items()), config.vocab_length, config.hidden_size,
+                        "gather" in config.custom_ops))
+    digest = hashlib.sha1(description.encode()).hexdigest()[:12]
+    return f"{file_path}.init_{np.dtype(config.dtype).name}_{digest}.npz"
+
+
+def _load_npz_cache(cache_path, file_path):
+    if not os.path.exists(cache_path):
+        return None
+    file_mtime = _tf_file_mtime(file_path)
+    if file_mtime is not None and os.path.getmtime(cache_path) < file_mtime:
+        logger.info(f"Ignoring stale initializer cache {cache_path}")
+        return None
+    logger.info(f"Loading initializers from {cache_path}")
+    with np.load(cache_path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+
+def _save_npz_cache(cache_path, initializers):
+    tmp_path = cache_path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **initializers)
+        os.replace(tmp_path, cache_path)
+        logger.info(f"Saved initializer cache to {cache_path}")
+    except OSError as err:
+        logger.warning(f"Could not save initializer cache to {cache_path}: {err}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
 def load_initializers_from_tf(
     file_path,
     is_checkpoint,
     config,
+    use_cache=False,
+    npz_cache=False,
 ):
     """
     Loads weights, etc. from Tensorflow files into a dictionary of Numpy Arrays.
 
     Can read either checkpoint files, or frozen graphs, according to the
     `is_checkpoint` flag, passed in as the second argument.
+
+    With `use_cache` the result is kept in memory and returned again for
+    later calls with the same unmodified file and model shape. The cached
+    arrays are shared between callers and must not be modified.
+
+    With `npz_cache` the converted initializers are also saved to an .npz
+    file next to `file_path` and loaded from there on later runs, which
+    avoids importing TensorFlow at all. The cache is ignored once the
+    TensorFlow file is newer than it.
     """
+    if use_cache:
+        key = (os.path.abspath(file_path), _tf_file_mtime(file_path), is_checkpoint,
+               config.num_layers, config.hidden_size, config.vocab_length,
+               tuple(config.custom_ops), str(config.dtype))
+        if key in _INIT_CACHE:
+            logger.info("Reusing initializers already loaded from {}".format(file_path))
+            return _INIT_CACHE[key]
+
     mapping = get_tf_mapping(config)
 
-    if is_checkpoint:
-        names, data = load_tf_ckpt_data(file_path, mapping)
-    else:
-        names, data = load_tf_frozen_data(file_path, mapping)
+    initializers = None
+    if npz_cache:
+        cache_path = _npz_cache_path(file_path, mapping, config)
+        initializers = _load_npz_cache(cache_path, file_path)
+
+    if initializers is None:
+        if is_checkpoint:
+            names, data = load_tf_ckpt_data(file_path, frozenset(mapping), config.dtype)
+        else:
+            names, data = load_tf_frozen_data(file_path, frozenset(mapping), config.dtype)
 
-    return generate_initializers(mapping, config, names, data)
+        initializers = generate_initializers(mapping, config, names, data)
+        if npz_cache:
+            _save_npz_cache(cache_path, initializers)
+
+    if use_cache:
+        _INIT_CACHE[key] = initializers
+    return initializers
 
 
 def load_model_from_tf(
@@ -279,6 +420,19 @@ if __name__ == "__main__":
         required=False,
         help="Path to the output PyTorch model.",
     )
+    parser.add_argument(
+        "--save-external-data",
+        action="store_true",
+        help="Store the weights in a '<model-output-path>.data' file next to\n"
+        "the model instead of inside it. This only splits the saved file;\n"
+        "the model is still built as a single proto so the 2GB protobuf\n"
+        "limit still applies.",
+    )
+    parser.add_argument(
+        "--validate",
+        action="store_true",
+        help="Run the ONNX checker on the model before saving it.",
+    )
     args = parser.parse_args()
 
     config = load_bert_config_tf(args.bert_config_file)
@@ -316,5 +470,15 @@ if __name__ == "__main__":
     logger.info("Graph parsed successfully.")
 
     if args.model_output_path is not None:
-        onnx_proto = onnx.load_model_from_string(proto)
-        onnx.save_model(onnx_proto, args.model_output_path)
+        if args.validate or args.save_external_data:
+            onnx_proto = onnx.load_model_from_string(proto)
+            if args.validate:
+                onnx.checker.check_model(onnx_proto)
+            if args.save_external_data:
+                save_model_with_external_data(onnx_proto, args.model_output_path)
+            else:
+                onnx.save_model(onnx_proto, args.model_output_path)
+        else:
+            # The builder's proto is already serialised so it can be written out as is
+            with open(args.model_output_path, "wb") as f:
+                f.write(proto)
@@ -0,0 +1,62 @@
+# Copyright 2019 Graphcore Ltd.
+import argparse
+
+import pytest
+
+import bert
+from bert import CallbackTimes, compute_latency
+
+
+def record_step(monkeypatch, events):
+    # events are (times, id, timestamp) recorded in order with a fixed clock
+    for times, id, timestamp in events:
+        monkeypatch.setattr(bert.time, "perf_counter", lambda: timestamp)
+        times.record(id)
+
+
+def step_events(start_times, end_times, batches_per_step, offset=0, swap_inputs=False):
+    events = []
+    for i in range(batches_per_step):
+        first, second = ("b", "a") if swap_inputs else ("a", "b")
+        t = offset + 10 * i
+        events += [(start_times, first, t), (start_times, second, t + 1),
+                   (end_times, "x", t + 5), (end_times, "y", t + 5 + i)]
+    return events
+
+
+def test_compute_latency(monkeypatch):
+    args = argparse.Namespace(low_latency_inference=True, task="SQUAD", batches_per_step=3)
+    start_times = CallbackTimes(args.batches_per_step)
+    end_times = CallbackTimes(args.batches_per_step)
+
+    record_step(monkeypatch, step_events(start_times, end_times, args.batches_per_step))
+    # Latency is measured from the first input sent to the last output returned
+    assert compute_latency(args, start_times, end_times) == (6, 5, 7)
+    assert start_times.timing_anchor == "a"
+    assert end_times.timing_anchor == "y"
+
+    # The anchors found on the first step are reused after clearing, even though "b" is now sent first
+    start_times.clear()
+    end_times.clear()
+    record_step(monkeypatch,
+                step_events(start_times, end_times, args.batches_per_step, offset=100, swap_inputs=True))
+    assert compute_latency(args, start_times, end_times) == (5, 4, 6)
+    assert start_times.timing_anchor == "a"
+
+
+def test_compute_latency_count_mismatch(monkeypatch):
+    args = argparse.Namespace(low_latency_inference=True, task="SQUAD", batches_per_step=3)
+    start_times = CallbackTimes(args.batches_per_step)
+    end_times = CallbackTimes(args.batches_per_step)
+
+    events = step_events(start_times, end_times, args.batches_per_step)
+    # An extra output for the timing anchor
+    events.append((end_times, "y", 100))
+    record_step(monkeypatch, events)
+    with pytest.raises(RuntimeError):
+        compute_latency(args, start_times, end_times)
+
+
+def test_compute_latency_disabled():
+    args = argparse.Namespace(low_latency_inference=False, task="SQUAD", batches_per_step=3)
+    assert compute_latency(args, CallbackTimes(3), CallbackTimes(3)) == (None, None, None)
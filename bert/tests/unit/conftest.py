@@ -4,16 +4,21 @@ import pytest
 
 
 def pytest_collection_modifyitems(config, items):
+    # Map each marker to a skip for when its option hasn't been given
+    skips = {}
+    if not config.getoption("--config-path"):
+        skips["requires_config"] = pytest.mark.skip(reason="Requires a config-graph path to run")
+    if not config.getoption("--chkpt-path"):
+        skips["requires_chkpt"] = pytest.mark.skip(reason="Requires a chkpt-graph path to run")
+    if not config.getoption("--frozen-path"):
+        skips["requires_frozen"] = pytest.mark.skip(reason="Requires a frozen-graph path to run")
+    if not skips:
+        return
+
     for item in items:
-        if "requires_config" in item.keywords and not config.getoption("--config-path"):
-            item.add_marker(pytest.mark.skip(
-                reason="Requires a config-graph path to run"))
-        if "requires_chkpt" in item.keywords and not config.getoption("--chkpt-path"):
-            item.add_marker(pytest.mark.skip(
-                reason="Requires a chkpt-graph path to run"))
-        if "requires_frozen" in item.keywords and not config.getoption("--frozen-path"):
-            item.add_marker(pytest.mark.skip(
-                reason="Requires a frozen-graph path to run"))
+        for keyword, skip in skips.items():
+            if keyword in item.keywords:
+                item.add_marker(skip)
 
 
 def pytest_addoption(parser):
@@ -0,0 +1,151 @@
+# Copyright 2019 Graphcore Ltd.
+import numpy as np
+import pytest
+
+import bert_tf_loader
+from bert_model import BertConfig
+from bert_tf_loader import get_tf_mapping, generate_initializers, cast_loaded_array
+
+
+def random_tf_weights(config, vocab_length):
+    weights = {}
+    for name, target in get_tf_mapping(config).items():
+        if target == "Embedding/Embedding_Dict":
+            shape = (vocab_length, config.hidden_size)
+        elif target == "Embedding/Positional_Dict":
+            shape = (config.max_positional_length, config.hidden_size)
+        elif name.endswith("kernel"):
+            shape = (config.hidden_size, config.hidden_size)
+        else:
+            shape = (config.hidden_size,)
+        weights[name] = np.random.rand(*shape).astype(np.float32)
+    return weights
+
+
+@pytest.mark.parametrize("custom_ops", [[], ["gather"]])
+@pytest.mark.parametrize("vocab_offset", [-3, 0, 5])
+@pytest.mark.parametrize("popart_dtype", ["FLOAT", "FLOAT16"])
+def test_generate_initializers(custom_ops, vocab_offset, popart_dtype):
+    config = BertConfig(num_layers=2,
+                        hidden_size=8,
+                        vocab_length=32,
+                        max_positional_length=16,
+                        custom_ops=custom_ops,
+                        popart_dtype=popart_dtype)
+    weights = random_tf_weights(config, config.vocab_length - vocab_offset)
+    mapping = get_tf_mapping(config)
+
+    # The loaders cast to the model dtype as the tensors are read
+    load_data = [cast_loaded_array(array, config.dtype) for array in weights.values()]
+    initializers = generate_initializers(mapping, config, list(weights.keys()), load_data)
+
+    assert set(initializers.keys()) == set(mapping.values())
+    for array in initializers.values():
+        assert array.flags["C_CONTIGUOUS"]
+        assert array.dtype == config.dtype
+
+    for i in range(config.num_layers):
+        expected_qkv = np.concatenate([
+            weights[f"bert/encoder/layer_{i}/attention/self/{part}/kernel"]
+            for part in ("query", "key", "value")], axis=1).astype(config.dtype)
+        assert initializers[f"Layer{i}/Attention/QKV"].shape == (config.hidden_size, 3 * config.hidden_size)
+        assert np.array_equal(initializers[f"Layer{i}/Attention/QKV"], expected_qkv)
+
+    embedding = weights["bert/embeddings/word_embeddings"][:config.vocab_length]
+    expected_embedding = np.zeros((config.vocab_length, config.hidden_size), dtype=config.dtype)
+    expected_embedding[:embedding.shape[0]] = embedding
+    if "gather" in custom_ops:
+        expected_embedding = expected_embedding.T
+    assert np.array_equal(initializers["Embedding/Embedding_Dict"], expected_embedding)
+
+
+def test_cast_loaded_array():
+    fp32 = np.random.rand(4, 4).astype(np.float32)
+    int32 = np.arange(4, dtype=np.int32)
+    assert cast_loaded_array(fp32, np.float16).dtype == np.float16
+    assert cast_loaded_array(fp32, np.float32) is fp32
+    assert cast_loaded_array(fp32) is fp32
+    assert cast_loaded_array(int32, np.float16) is int32
+
+
+CACHE_TEST_CONFIG = BertConfig(num_layers=1, hidden_size=8, vocab_length=32, max_positional_length=16)
+
+
+@pytest.fixture
+def fake_checkpoint(tmp_path, monkeypatch):
+    """
+    A checkpoint path whose TF loading is replaced by random weights.
+    Returns the path and the list of paths passed to `load_tf_ckpt_data`.
+    """
+    weights = random_tf_weights(CACHE_TEST_CONFIG, CACHE_TEST_CONFIG.vocab_length)
+    checkpoint = tmp_path / "model.ckpt"
+    checkpoint.with_suffix(".ckpt.index").write_bytes(b"")
+
+    loads = []
+
+    def fake_load(path, name_filter, target_dtype=None):
+        loads.append(path)
+        return list(weights.keys()), list(weights.values())
+
+    monkeypatch.setattr(bert_tf_loader, "load_tf_ckpt_data", fake_load)
+    bert_tf_loader.clear_initializer_cache()
+    yield str(checkpoint), loads
+    bert_tf_loader.clear_initializer_cache()
+
+
+def test_initializer_cache(fake_checkpoint):
+    checkpoint, loads = fake_checkpoint
+    config = CACHE_TEST_CONFIG
+
+    first = bert_tf_loader.load_initializers_from_tf(checkpoint, True, config, use_cache=True)
+    second = bert_tf_loader.load_initializers_from_tf(checkpoint, True, config, use_cache=True)
+    assert first is second
+    assert len(loads) == 1
+
+    bert_tf_loader.load_initializers_from_tf(checkpoint, True, config)
+    assert len(loads) == 2
+
+    bert_tf_loader.clear_initializer_cache()
+    bert_tf_loader.load_initializers_from_tf(checkpoint, True, config, use_cache=True)
+    assert len(loads) == 3
+
+
+def test_initializer_npz_cache(fake_checkpoint, tmp_path):
+    checkpoint, loads = fake_checkpoint
+    config = CACHE_TEST_CONFIG
+
+    first = bert_tf_loader.load_initializers_from_tf(checkpoint, True, config, npz_cache=True)
+    assert len(list(tmp_path.glob("model.ckpt.init_*.npz"))) == 1
+
+    second = bert_tf_loader.load_initializers_from_tf(checkpoint, True, config, npz_cache=True)
+    assert len(loads) == 1
+    assert first.keys() == second.keys()
+    for name in first:
+        assert np.array_equal(first[name], second[name])
+
+
+def test_generate_initializers_incomplete_qkv():
+    config = BertConfig(num_layers=1, hidden_size=8, vocab_length=32, max_positional_length=16)
+    weights = random_tf_weights(config, config.vocab_length)
+    del weights["bert/encoder/layer_0/attention/self/key/kernel"]
+
+    with pytest.raises(ValueError, match="key"):
+        generate_initializers(get_tf_mapping(config), config, list(weights.keys()), list(weights.values()))
+
+
+def test_generate_initializers_does_not_copy_unmodified_tensors():
+    config = BertConfig(num_layers=1, hidden_size=8, vocab_length=32, max_positional_length=16)
+    weights = random_tf_weights(config, config.vocab_length)
+
+    initializers = generate_initializers(get_tf_mapping(config), config, list(weights.keys()), list(weights.values()))
+
+    assert initializers["Embedding/Embedding_Dict"] is weights["bert/embeddings/word_embeddings"]
+    assert initializers["Embedding/Gamma"] is weights["bert/embeddings/LayerNorm/gamma"]
+
+
+def test_tf_mapping_is_read_only():
+    config = BertConfig(num_layers=2)
+    mapping = get_tf_mapping(config)
+    with pytest.raises(TypeError):
+        mapping["bert/embeddings/word_embeddings"] = "Changed"
+    assert get_tf_mapping(config)["bert/embeddings/word_embeddings"] == "Embedding/Embedding_Dict"
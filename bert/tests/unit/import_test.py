@@ -0,0 +1,11 @@
+# Copyright 2019 Graphcore Ltd.
+import subprocess
+import sys
+from pathlib import Path
+
+
+def test_bert_import_does_not_load_tensorflow():
+    # Run in a fresh interpreter as other tests may have already imported TensorFlow
+    bert_dir = Path(__file__).parent.parent.parent.resolve()
+    check = "import sys, bert, bert_tf_loader; assert 'tensorflow' not in sys.modules"
+    subprocess.run([sys.executable, "-c", check], cwd=str(bert_dir), check=True)
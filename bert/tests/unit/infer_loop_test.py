@@ -0,0 +1,68 @@
+# Copyright 2019 Graphcore Ltd.
+import argparse
+import time
+
+import numpy as np
+
+import bert
+from bert import Iteration, bert_infer_loop
+
+
+class FakeSession:
+    # Writes each batch's uids into the anchors so the results can be matched to their batch
+    def __init__(self, logits):
+        self.logits = logits
+        self.anchor_sets = []
+
+    def run(self, stepio):
+        data, anchors = stepio
+        self.anchor_sets.append(id(anchors))
+        for i, logit in enumerate(self.logits):
+            anchors[logit][:] = data["uid"] + i
+
+
+class FakeSquadDataSet:
+    def __init__(self, num_batches, batch_size):
+        self.batches = [{"uid": np.arange(batch_size) + batch_size * i} for i in range(num_batches)]
+        self.results = []
+        self.predictions_written = False
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def add_results(self, data, logits):
+        # Slow enough for the next step to run while this is being processed
+        time.sleep(0.01)
+        self.results.append((data["uid"].copy(), [logit.copy() for logit in logits]))
+
+    def write_predictions(self):
+        self.predictions_written = True
+
+
+def test_infer_loop_double_buffered_results(monkeypatch):
+    monkeypatch.setattr(bert.popart, "PyStepIO", lambda data, anchors: (data, anchors), raising=False)
+    args = argparse.Namespace(
+        task="SQUAD", synthetic_data=False, low_latency_inference=False, batches_per_step=1,
+        prefetch_depth=2, realtime_scheduler=False, report_hw_cycle_count=False, gc_profile=False,
+        continue_training_from_epoch=0, epochs=1, epochs_per_save=1, steps_per_log=1,
+        gradient_accumulation_factor=1, replication_factor=1, batch_size=4)
+    logits = ["start_logits", "end_logits"]
+    anchors = {logit: np.zeros(args.batch_size, dtype=np.int64) for logit in logits}
+    dataset = FakeSquadDataSet(num_batches=10, batch_size=args.batch_size)
+    session = FakeSession(logits)
+    iteration = Iteration(args, batches_per_step=1, steps_per_epoch=len(dataset), writer=None)
+
+    bert_infer_loop(args, session, dataset, logits, anchors, iteration)
+
+    # The anchor sets alternate between steps
+    assert len(set(session.anchor_sets)) == 2
+    assert all(a != b for a, b in zip(session.anchor_sets, session.anchor_sets[1:]))
+    # Every result is processed, in order, with the logits from its own step
+    assert [uid.tolist() for uid, _ in dataset.results] == [batch["uid"].tolist() for batch in dataset.batches]
+    for uid, (start, end) in dataset.results:
+        assert np.array_equal(start, uid)
+        assert np.array_equal(end, uid + 1)
+    assert dataset.predictions_written
@@ -0,0 +1,49 @@
+# Copyright 2019 Graphcore Ltd.
+import os
+
+import numpy as np
+import onnx
+from onnx import helper, numpy_helper, TensorProto
+
+from utils import load_initializers_from_onnx, save_model_with_external_data
+
+
+def fp16_int32_initializer(name, array):
+    # Float16 data packed into int32_data, in the same way as the popart builder
+    tensor = TensorProto()
+    tensor.name = name
+    tensor.data_type = TensorProto.FLOAT16
+    tensor.dims.extend(array.shape)
+    tensor.int32_data.extend(array.ravel().view(np.int32).tolist())
+    return tensor
+
+
+def test_save_model_with_external_data(tmp_path):
+    weights = {
+        "Large": np.random.rand(64, 32).astype(np.float32),
+        "Small": np.random.rand(4).astype(np.float32),
+        "LargeHalf": np.random.rand(64, 32).astype(np.float16),
+    }
+    initializers = [numpy_helper.from_array(weights["Large"], "Large"),
+                    numpy_helper.from_array(weights["Small"], "Small"),
+                    fp16_int32_initializer("LargeHalf", weights["LargeHalf"])]
+    graph = helper.make_graph([], "test", [], [], initializer=initializers)
+    model = helper.make_model(graph)
+
+    model_path = str(tmp_path / "model.onnx")
+    save_model_with_external_data(model, model_path)
+
+    assert os.path.exists(model_path + ".data")
+    saved = onnx.load(model_path, load_external_data=False)
+    external = {t.name for t in saved.graph.initializer if t.data_location == TensorProto.EXTERNAL}
+    assert external == {"Large", "LargeHalf"}
+
+    loaded = load_initializers_from_onnx(model_path)
+    for name, array in weights.items():
+        assert loaded[name].dtype == array.dtype
+        assert np.array_equal(loaded[name], array)
+
+    # Saving again must not append to the old data file
+    data_size = os.path.getsize(model_path + ".data")
+    save_model_with_external_data(onnx.load(model_path), model_path)
+    assert os.path.getsize(model_path + ".data") == data_size
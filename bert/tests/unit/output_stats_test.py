@@ -0,0 +1,130 @@
+# Copyright 2019 Graphcore Ltd.
+import numpy as np
+import pytest
+
+import bert
+from bert import bert_output_stats, RollingAverage
+
+
+@pytest.fixture(params=["numba", "numpy"])
+def reduction(request, monkeypatch):
+    # bert_output_stats uses the Numba kernel whenever it is available so force each path in turn
+    if request.param == "numba":
+        if bert._reduce_kernel is None:
+            pytest.skip("Numba is not installed")
+    else:
+        monkeypatch.setattr(bert, "_reduce_kernel", None)
+    return request.param
+
+
+def reference_output_stats(labels, losses, predictions, ignore_index=None):
+    total_loss = 0
+    total_tokens = 0
+    total_correct = 0
+    total_attempted = 0
+    for idx in np.ndindex(labels[0].shape):
+        token_losses = [loss[idx] for loss, label in zip(losses, labels)
+                        if ignore_index is None or label[idx] != ignore_index]
+        if token_losses:
+            total_loss += sum(token_losses) / len(token_losses)
+            total_tokens += 1
+        for pred, label in zip(predictions, labels):
+            if ignore_index is None or label[idx] != ignore_index:
+                total_correct += pred[idx] == label[idx]
+                total_attempted += 1
+    return total_loss / total_tokens, total_correct / total_attempted
+
+
+@pytest.mark.parametrize("num_outputs, shape, ignore_index", [
+    (1, (4, 20), 0),
+    (1, (4,), 2),
+    (2, (3, 4), None),
+])
+def test_output_stats(reduction, num_outputs, shape, ignore_index):
+    np.random.seed(1984)
+    labels = [np.random.randint(0, 3, shape).astype(np.uint32) for _ in range(num_outputs)]
+    losses = [np.random.rand(*shape).astype(np.float32) for _ in range(num_outputs)]
+    predictions = [np.random.randint(0, 3, shape).astype(np.uint32) for _ in range(num_outputs)]
+
+    loss_anchors = [loss.copy() for loss in losses]
+
+    step_loss, step_accuracy = bert_output_stats(labels, loss_anchors, predictions, ignore_index)
+    ref_loss, ref_accuracy = reference_output_stats(labels, losses, predictions, ignore_index)
+
+    assert np.allclose(step_loss, ref_loss, rtol=1e-5)
+    assert np.allclose(step_accuracy, ref_accuracy)
+
+
+def test_rolling_average():
+    values = np.random.rand(50)
+    window = 8
+    rolling = RollingAverage(window)
+    for i, value in enumerate(values):
+        rolling.append(value)
+        expected = values[max(0, i + 1 - window):i + 1]
+        assert len(rolling) == len(expected)
+        assert np.allclose(rolling.mean(), np.mean(expected))
+        assert np.allclose(np.asarray(rolling), expected)
+        assert rolling[-1] == value
+
+
+@pytest.mark.parametrize("bad_value", [np.nan, np.inf])
+def test_rolling_average_recovers_from_non_finite(bad_value):
+    window = 4
+    rolling = RollingAverage(window)
+    rolling.append(1.0)
+    rolling.append(bad_value)
+    assert not np.isfinite(rolling.mean())
+    for _ in range(window - 1):
+        rolling.append(2.0)
+        assert not np.isfinite(rolling.mean())
+    rolling.append(2.0)
+    assert rolling.mean() == 2.0
+
+
+def test_output_stats_leaves_anchors_unchanged(reduction):
+    labels = [np.array([[0, 1, 2], [3, 0, 0]], dtype=np.uint32)]
+    losses = [np.random.rand(2, 3).astype(np.float32)]
+    predictions = [np.array([[1, 1, 2], [0, 0, 0]], dtype=np.uint32)]
+    original = losses[0].copy()
+
+    bert_output_stats(labels, losses, predictions, 0)
+
+    assert np.array_equal(losses[0], original)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning")
+def test_output_stats_all_ignored(reduction):
+    labels = [np.zeros((4, 20), dtype=np.uint32)]
+    losses = [np.random.rand(4, 20).astype(np.float32)]
+    predictions = [np.zeros((4, 20), dtype=np.uint32)]
+
+    step_loss, step_accuracy = bert_output_stats(labels, losses, predictions, 0)
+
+    assert np.isnan(step_loss)
+    assert np.isnan(step_accuracy)
+
+
+@pytest.mark.parametrize("bad_value", [np.inf, np.nan])
+def test_output_stats_ignores_non_finite_padding(reduction, bad_value):
+    labels = [np.array([[0, 1, 1, 1]], dtype=np.uint32)]
+    losses = [np.array([[bad_value, 1, 1, 1]], dtype=np.float32)]
+    predictions = [np.array([[1, 1, 1, 0]], dtype=np.uint32)]
+
+    step_loss, step_accuracy = bert_output_stats(labels, losses, predictions, 0)
+
+    assert step_loss == 1.0
+    assert np.isclose(step_accuracy, 2 / 3)
+
+
+@pytest.mark.parametrize("bad_value", [np.inf, np.nan])
+def test_output_stats_non_finite_loss(reduction, bad_value):
+    # fp16 overflow steps produce non-finite losses which must be reported, not hidden
+    labels = [np.array([[0, 1, 1, 1]], dtype=np.uint32)]
+    losses = [np.array([[1, bad_value, 1, 1]], dtype=np.float32)]
+    predictions = [np.array([[1, 1, 1, 0]], dtype=np.uint32)]
+
+    step_loss, _ = bert_output_stats(labels, losses, predictions, 0)
+    ref_loss, _ = reference_output_stats(labels, losses, predictions, 0)
+
+    np.testing.assert_equal(step_loss, ref_loss)
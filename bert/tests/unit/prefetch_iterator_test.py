@@ -0,0 +1,101 @@
+# Copyright 2019 Graphcore Ltd.
+import itertools
+import threading
+import time
+
+import pytest
+
+from bert import PrefetchIterator
+
+
+class ListDataSet:
+    # Like the bert_data datasets, iterating restarts the pass and returns self
+    def __init__(self, items):
+        self.items = items
+        self.passes = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        self.passes += 1
+        self.index = 0
+        return self
+
+    def __next__(self):
+        if self.index >= len(self.items):
+            raise StopIteration
+        self.index += 1
+        return self.items[self.index - 1]
+
+
+class EndlessDataSet:
+    def __init__(self):
+        self.produced = 0
+
+    def __iter__(self):
+        for self.produced in itertools.count(1):
+            yield self.produced
+
+
+class FailingDataSet:
+    def __iter__(self):
+        yield 0
+        yield 1
+        raise ValueError("Bad batch")
+
+
+def wait_for_thread_count(count, timeout=5):
+    deadline = time.time() + timeout
+    while threading.active_count() > count and time.time() < deadline:
+        time.sleep(0.01)
+    return threading.active_count()
+
+
+@pytest.mark.parametrize("depth", [1, 2, 8])
+def test_prefetch_preserves_order(depth):
+    items = list(range(100))
+    batches = PrefetchIterator(ListDataSet(items), depth)
+    assert len(batches) == len(items)
+    assert list(batches) == items
+
+
+def test_prefetch_reraises_dataset_errors():
+    received = []
+    with pytest.raises(ValueError, match="Bad batch"):
+        for item in PrefetchIterator(FailingDataSet(), 2):
+            received.append(item)
+    assert received == [0, 1]
+
+
+def test_prefetch_stops_producer_on_early_exit():
+    threads = threading.active_count()
+    dataset = EndlessDataSet()
+    for item in PrefetchIterator(dataset, 2):
+        if item == 5:
+            break
+
+    assert wait_for_thread_count(threads) == threads
+    produced = dataset.produced
+    time.sleep(0.2)
+    # The producer can be at most a full queue ahead and must not carry on once stopped
+    assert produced <= 5 + 2 + 1
+    assert dataset.produced == produced
+
+
+def test_prefetch_disabled():
+    threads = threading.active_count()
+    dataset = ListDataSet(list(range(10)))
+    batches = PrefetchIterator(dataset, 0)
+    iterator = iter(batches)
+    assert iterator is dataset
+    assert list(iterator) == list(range(10))
+    assert threading.active_count() == threads
+
+
+def test_prefetch_reiterates_from_start():
+    dataset = ListDataSet(list(range(10)))
+    batches = PrefetchIterator(dataset, 2)
+    for epoch in range(3):
+        assert list(batches) == list(range(10))
+    assert dataset.passes == 3
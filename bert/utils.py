@@ -16,19 +16,49 @@ from bert_model import BertConfig
 logger = getLogger(__name__)
 
 
+def onnx_initializer_to_array(weight):
+    if weight.data_type == TensorProto.FLOAT16 and not weight.HasField("raw_data"):
+        int_data = np.asarray(weight.int32_data, np.int32)
+        return int_data.view(dtype=np.float16).reshape(weight.dims)
+    return numpy_helper.to_array(weight)
+
+
 def load_initializers_from_onnx(model_path):
     initializers = {}
     model = onnx.load(model_path)
     for weight in model.graph.initializer:
-        if weight.data_type == TensorProto.FLOAT16:
-            int_data = np.asarray(weight.int32_data, np.int32)
-            np_weight = int_data.view(dtype=np.float16).reshape(weight.dims)
-        else:
-            np_weight = numpy_helper.to_array(weight)
-        initializers[weight.name] = np_weight
+        initializers[weight.name] = onnx_initializer_to_array(weight)
     return initializers
 
 
+def save_model_with_external_data(model, model_path, size_threshold=1024):
+    """
+    Saves `model` to `model_path` with the data of every initializer of at least
+    `size_threshold` bytes moved to a single '<model_path>.data' file next to it.
+    """
+    from onnx.external_data_helper import set_external_data
+
+    location = os.path.basename(model_path) + ".data"
+    data_path = os.path.join(os.path.dirname(model_path), location)
+    # onnx appends to the data file so any file left from a previous save must go
+    if os.path.exists(data_path):
+        os.remove(data_path)
+
+    for weight in model.graph.initializer:
+        if not weight.HasField("raw_data"):
+            # Only raw_data can be moved to the external file
+            np_weight = onnx_initializer_to_array(weight)
+            if np_weight.nbytes < size_threshold:
+                continue
+            for field in ("float_data", "int32_data", "int64_data", "double_data", "uint64_data"):
+                weight.ClearField(field)
+            weight.raw_data = np_weight.tobytes()
+        elif len(weight.raw_data) < size_threshold:
+            continue
+        set_external_data(weight, location)
+    onnx.save_model(model, model_path)
+
+
 def save_model_statistics(model_path, writer, i=0):
     initializers = load_initializers_from_onnx(model_path)
     for name, np_weight in initializers.items():
@@ -256,11 +286,18 @@ def parse_bert_args(args_string=None):
                             "the loss scaling at that step. \n"
                             "E.g.: --ls-schedule-by-step 0:0.00001 2500:0.0001 10000:0.0008 50000:0.00004 100000:0.00002")
 
-    group = parser.add_argument_group("Initialisation Config", "Flags for initialising the weights").add_mutually_exclusive_group()
+    init_group = parser.add_argument_group("Initialisation Config", "Flags for initialising the weights")
+    group = init_group.add_mutually_exclusive_group()
     group.add_argument("--tf-checkpoint", type=str,
                        help="Path to Tensorflow Checkpoint to initialise the model.")
     group.add_argument("--onnx-checkpoint", type=str,
                        help="Path to .onnx file created by this application to initialise the model.")
+    init_group.add_argument("--cache-loaded-weights", type=str_to_bool, nargs="?", const=True, default=False,
+                            help="Keep the weights loaded from --tf-checkpoint in host memory so that later runs in the same "
+                                 "process (e.g. a --validation-config that reuses the checkpoint) do not parse it again.")
+    init_group.add_argument("--tf-checkpoint-npz-cache", type=str_to_bool, nargs="?", const=True, default=False,
+                            help="Save the weights converted from --tf-checkpoint to an .npz file next to the checkpoint "
+                                 "and load them from there on later runs, skipping TensorFlow.")
 
     group = parser.add_argument_group("Data Config")
     group.add_argument("--input-files", type=str, nargs="*",
@@ -281,6 +318,8 @@ def parse_bert_args(args_string=None):
                             " (# of samples in input-files)/duplication-factor")
     group.add_argument("--epochs-to-cache", type=int, default=0,
                        help="Number of epochs of data to load into memory during PRETRAINING. Default is to load input files as needed.")
+    group.add_argument("--prefetch-depth", type=int, default=2,
+                       help="Number of batches to prepare on a background thread while the device is running. Set to 0 to disable prefetching.")
 
     group = parser.add_argument_group("Execution Config")
 
@@ -332,7 +371,7 @@ def parse_bert_args(args_string=None):
                        help="Use input/output callbacks to minimise inference latency for tasks that support this mode.")
     group.add_argument("--realtime-scheduler", action="store_true",
                        help="Set a realtime scheduler for this process. Only activated during inference. \
-                             (IMPORTANT: Requires non-interactive sudo, otherwise has no effect)")
+                             (IMPORTANT: Requires CAP_SYS_NICE or non-interactive sudo, otherwise has no effect)")
     group.add_argument("--max-copy-merge-size", type=int, default=-1,
                        help="Set the value for Poplar engine option 'opt.maxCopyMergeSize'. Set to -1 to use Poplar's default.")
     group.add_argument("--disable-fully-connected-pass", type=str_to_bool, nargs="?", const=True, default=False,